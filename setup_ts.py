@@ -9,9 +9,21 @@ It compiles TypeScript source files in `ts` directory,
 and copies (or links) JavaScript output as well as dependencies to `nni_node`.
 
 You can set environment `GLOBAL_TOOLCHAIN=1` to use global node and yarn, if you know what you are doing.
+
+Downloaded node and yarn archives are cached in `~/.cache/nni/toolchain`,
+set environment `NNI_TOOLCHAIN_CACHE` to use another directory.
+Likewise yarn packages are cached in `~/.cache/nni/yarn` unless `YARN_CACHE_FOLDER` is set,
+so CI can point it to a persistent cache to skip fetching packages.
+Set environment `NNI_YARN_NETWORK_CONCURRENCY` to override yarn's `--network-concurrency`.
+
+Set environment `NNI_DEDUPE_LOCK=1` to deduplicate package versions in `yarn.lock` files before installing.
+This modifies the lockfiles in place, which is meant for development.
+CI does not check for duplicates yet, because the committed lockfiles have not been deduplicated.
 """
 
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import hashlib
 import json
 import os
 from pathlib import Path
@@ -26,14 +38,16 @@ from zipfile import ZipFile
 node_version = 'v16.3.0'
 yarn_version = 'v1.22.10'
 
-def _get_jupyter_lab_version():
+toolchain_cache = Path(os.environ.get('NNI_TOOLCHAIN_CACHE', Path.home() / '.cache/nni/toolchain'))
+
+@lru_cache(maxsize=None)
+def _get_jupyter_lab_major_version():
+    # imported lazily because jupyterlab is slow to import and not needed by `clean()`
     try:
         import jupyterlab
-        return jupyterlab.__version__
+        return jupyterlab.__version__.split('.')[0]
     except ImportError:
-        return '3.x'
-
-jupyter_lab_major_version = _get_jupyter_lab_version().split('.')[0]
+        return '3'
 
 def build(release):
     """
@@ -60,26 +74,32 @@ def clean(clean_all=False):
     """
     Remove TypeScript-related intermediate files.
     Python intermediate files are not touched here.
-    """
-    shutil.rmtree('nni_node', ignore_errors=True)
-
-    for file_or_dir in generated_files:
-        path = Path(file_or_dir)
-        if path.is_symlink() or path.is_file():
-            path.unlink()
-        elif path.is_dir():
-            shutil.rmtree(path)
 
-    if clean_all:
-        shutil.rmtree('toolchain', ignore_errors=True)
+    The directories are independent and `node_modules` can be huge, so they are removed concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(shutil.rmtree, 'nni_node', ignore_errors=True)]
+        futures += [executor.submit(_remove, path) for path in generated_files]
+        if clean_all:
+            futures.append(executor.submit(shutil.rmtree, 'toolchain', ignore_errors=True))
+        for future in futures:
+            future.result()
+
+def _remove(file_or_dir):
+    path = Path(file_or_dir)
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
 
 
 if sys.platform == 'linux' or sys.platform == 'darwin':
     node_executable = 'node'
     node_spec = f'node-{node_version}-{sys.platform}-x64'
     node_download_url = f'https://nodejs.org/dist/{node_version}/{node_spec}.tar.xz'
-    node_extractor = lambda data: tarfile.open(fileobj=BytesIO(data), mode='r:xz')
+    node_extractor = lambda path: _extract_tar(path, 'r:xz', 'toolchain')
     node_executable_in_tarball = 'bin/node'
+    npx_executable_in_tarball = 'bin/npx'
 
     yarn_executable = 'yarn'
     yarn_download_url = f'https://github.com/yarnpkg/yarn/releases/download/{yarn_version}/yarn-{yarn_version}.tar.gz'
@@ -90,8 +110,9 @@ elif sys.platform == 'win32':
     node_executable = 'node.exe'
     node_spec = f'node-{node_version}-win-x64'
     node_download_url = f'https://nodejs.org/dist/{node_version}/{node_spec}.zip'
-    node_extractor = lambda data: ZipFile(BytesIO(data))
+    node_extractor = lambda path: _extract_zip(path, 'toolchain')
     node_executable_in_tarball = 'node.exe'
+    npx_executable_in_tarball = 'npx.cmd'
 
     yarn_executable = 'yarn.cmd'
     yarn_download_url = f'https://github.com/yarnpkg/yarn/releases/download/{yarn_version}/yarn-{yarn_version}.tar.gz'
@@ -105,50 +126,112 @@ else:
 def download_toolchain():
     """
     Download and extract node and yarn.
+    The two downloads are independent, so they run concurrently.
     """
-    if Path('toolchain/node', node_executable_in_tarball).is_file():
+    if Path('toolchain/node', node_executable_in_tarball).is_file() and Path('toolchain/yarn/bin', yarn_executable).is_file():
         return
 
     Path('toolchain').mkdir(exist_ok=True)
-    import requests  # place it here so setup.py can install it before importing
+    with _create_session() as session, ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(_download_node, session), executor.submit(_download_yarn, session)]
+        for future in futures:
+            future.result()
 
-    _print(f'Downloading node.js from {node_download_url}')
-    resp = requests.get(node_download_url)
-    resp.raise_for_status()
+def _create_session():
+    """
+    Create an HTTP session that keeps connections alive and retries on transient failures.
+    """
+    import requests  # place it here so setup.py can install it before importing
+    from urllib3.util.retry import Retry
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retry))
+    session.mount('http://', requests.adapters.HTTPAdapter(max_retries=retry))
+    return session
+
+def _download_node(session):
+    if Path('toolchain/node', node_executable_in_tarball).is_file():
+        return
+    archive = _fetch(session, node_download_url)
     _print('Extracting node.js')
-    tarball = node_extractor(resp.content)
-    tarball.extractall('toolchain')
+    _extract_cached(node_extractor, archive)
     shutil.rmtree('toolchain/node', ignore_errors=True)
     Path('toolchain', node_spec).rename('toolchain/node')
 
-    _print(f'Downloading yarn from {yarn_download_url}')
-    resp = requests.get(yarn_download_url)
-    resp.raise_for_status()
+def _download_yarn(session):
+    if Path('toolchain/yarn/bin', yarn_executable).is_file():
+        return
+    archive = _fetch(session, yarn_download_url)
     _print('Extracting yarn')
-    tarball = tarfile.open(fileobj=BytesIO(resp.content), mode='r:gz')
-    tarball.extractall('toolchain')
+    _extract_cached(lambda path: _extract_tar(path, 'r:gz', 'toolchain'), archive)
     shutil.rmtree('toolchain/yarn', ignore_errors=True)
     Path(f'toolchain/yarn-{yarn_version}').rename('toolchain/yarn')
 
+def _fetch(session, url):
+    """
+    Get path of the archive in download cache. Download it if not cached yet.
+    The archive is streamed to disk and only appears in cache after fully downloaded.
+    """
+    path = toolchain_cache / url.split('/')[-1]
+    if path.is_file() and path.stat().st_size > 0:
+        _print(f'Using cached {path}')
+        return path
+
+    _print(f'Downloading {url}')
+    toolchain_cache.mkdir(parents=True, exist_ok=True)
+    resp = session.get(url, stream=True, timeout=60)
+    resp.raise_for_status()
+    resp.raw.decode_content = True
+    expected_size = resp.headers.get('Content-Length')
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.part')
+    try:
+        with tmp_path.open('wb') as f:
+            shutil.copyfileobj(resp.raw, f)
+        # urllib3 1.x does not treat truncated body as error; `tell()` counts bytes before decoding
+        if expected_size is not None and resp.raw.tell() != int(expected_size):
+            raise RuntimeError(f'Incomplete download of {url}: got {resp.raw.tell()} of {expected_size} bytes')
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return path
+
+def _extract_cached(extractor, archive):
+    try:
+        extractor(archive)
+    except Exception:
+        # the cached archive is likely corrupted, remove it so next build downloads it again
+        _print(f'Failed to extract {archive}, removing it from cache', color='yellow')
+        archive.unlink()
+        raise
+
+def _extract_zip(path, dst):
+    with ZipFile(path) as zip_file:
+        zip_file.extractall(dst)
+
+def _extract_tar(path, mode, dst):
+    with tarfile.open(path, mode) as tarball:
+        tarball.extractall(dst)
+
 def update_package():
-    if jupyter_lab_major_version == '2':
-        package_json = json.load(open('ts/jupyter_extension/package.json'))
-        json.dump(package_json, open('ts/jupyter_extension/.package_default.json', 'w'), indent=2)
+    if _get_jupyter_lab_major_version() == '2':
+        # keep the original file byte-for-byte so restoring it does not reformat package.json
+        shutil.copyfile('ts/jupyter_extension/package.json', 'ts/jupyter_extension/.package_default.json')
+        package_json = json.loads(Path('ts/jupyter_extension/package.json').read_text())
 
         package_json['scripts']['build'] = 'tsc && jupyter labextension link .'
         package_json['dependencies']['@jupyterlab/application'] = '^2.3.0'
         package_json['dependencies']['@jupyterlab/launcher'] = '^2.3.0'
 
         package_json['jupyterlab']['outputDir'] = 'build'
-        json.dump(package_json, open('ts/jupyter_extension/package.json', 'w'), indent=2)
-        print(f'updated package.json with {json.dumps(package_json, indent=2)}')
+        content = json.dumps(package_json, indent=2)
+        Path('ts/jupyter_extension/package.json').write_text(content)
+        print(f'updated package.json with {content}')
 
 def restore_package():
-    if jupyter_lab_major_version == '2':
-        package_json = json.load(open('ts/jupyter_extension/.package_default.json'))
-        print(f'stored package.json with {json.dumps(package_json, indent=2)}')
-        json.dump(package_json, open('ts/jupyter_extension/package.json', 'w'), indent=2)
-        os.remove('ts/jupyter_extension/.package_default.json')
+    if _get_jupyter_lab_major_version() == '2':
+        print(f'stored package.json with {Path("ts/jupyter_extension/.package_default.json").read_text()}')
+        os.replace('ts/jupyter_extension/.package_default.json', 'ts/jupyter_extension/package.json')
 
 def prepare_nni_node():
     """
@@ -167,30 +250,47 @@ def prepare_nni_node():
 def compile_ts(release):
     """
     Use yarn to download dependencies and compile TypeScript code.
+
+    The three TypeScript projects do not depend on each other, so they are built concurrently.
+    Dependencies are installed one project at a time, because concurrent installs can corrupt the shared yarn cache.
+    JupyterLab extension is optional in develop mode; its failure is reported as warning.
     """
-    _print('Building NNI manager')
-    _yarn('ts/nni_manager')
-    _yarn('ts/nni_manager', 'build')
+    projects = ['ts/nni_manager', 'ts/webui', 'ts/jupyter_extension']
+    optional = [] if release else ['ts/jupyter_extension']
+
+    if os.environ.get('NNI_DEDUPE_LOCK'):
+        for path in projects:
+            _print(f'Deduplicating {path}/yarn.lock')
+            _dedupe_lock(path)
+
+    jupyter_output = 'build' if _get_jupyter_lab_major_version() == '2' else 'dist'
+    if not release and not _needs_build('ts/jupyter_extension', jupyter_output):
+        _print('JupyterLab extension is up to date, skip building')
+        projects.remove('ts/jupyter_extension')
+    elif Path('ts/jupyter_extension/.build_stamp').exists():
+        os.remove('ts/jupyter_extension/.build_stamp')  # only write it back if the build succeeds
+
+    _print('Installing dependencies of ' + ', '.join(projects))
+    failed = set()
+    for path in projects:
+        try:
+            _yarn(path)
+        except Exception:
+            if path not in optional:
+                raise
+            _print_skipped(path)
+            failed.add(path)
+
+    _print('Building ' + ', '.join(path for path in projects if path not in failed))
+    failed |= _yarn_parallel([(path, 'build') for path in projects if path not in failed], optional)
+
+    if 'ts/jupyter_extension' in projects and 'ts/jupyter_extension' not in failed:
+        Path('ts/jupyter_extension/.build_stamp').write_text(_hash_project('ts/jupyter_extension'))
+
     # todo: I don't think these should be here
     shutil.rmtree('ts/nni_manager/dist/config', ignore_errors=True)
     shutil.copytree('ts/nni_manager/config', 'ts/nni_manager/dist/config')
 
-    _print('Building web UI')
-    _yarn('ts/webui')
-    _yarn('ts/webui', 'build')
-
-    _print('Building JupyterLab extension')
-    if release:
-        _yarn('ts/jupyter_extension')
-        _yarn('ts/jupyter_extension', 'build')
-    else:
-        try:
-            _yarn('ts/jupyter_extension')
-            _yarn('ts/jupyter_extension', 'build')
-        except Exception:
-            _print('Failed to build JupyterLab extension, skip for develop mode', color='yellow')
-            _print(traceback.format_exc(), color='yellow')
-
 
 def symlink_nni_node():
     """
@@ -199,14 +299,16 @@ def symlink_nni_node():
     """
     _print('Creating symlinks')
 
-    for path in Path('ts/nni_manager/dist').iterdir():
-        _symlink(path, Path('nni_node', path.name))
+    with os.scandir('ts/nni_manager/dist') as it:
+        for entry in it:
+            relative = os.path.relpath(entry.path, 'nni_node')
+            os.symlink(relative, os.path.join('nni_node', entry.name), entry.is_dir())
     _symlink('ts/nni_manager/package.json', 'nni_node/package.json')
     _symlink('ts/nni_manager/node_modules', 'nni_node/node_modules')
 
     _symlink('ts/webui/build', 'nni_node/static')
 
-    if jupyter_lab_major_version == '2':
+    if _get_jupyter_lab_major_version() == '2':
         _symlink('ts/jupyter_extension/build', 'nni_node/jupyter-extension')
         _symlink(os.path.join(sys.exec_prefix, 'share/jupyter/lab/extensions'), 'nni_node/jupyter-extension/extensions')
     elif Path('ts/jupyter_extension/dist').exists():
@@ -222,42 +324,156 @@ def copy_nni_node(version):
     """
     _print('Copying files')
 
-    # copytree(..., dirs_exist_ok=True) is not supported by Python 3.6
-    for path in Path('ts/nni_manager/dist').iterdir():
-        if path.is_dir():
-            shutil.copytree(path, Path('nni_node', path.name))
-        elif path.name != 'nni_manager.tsbuildinfo':
-            shutil.copyfile(path, Path('nni_node', path.name))
+    # release package must be standalone; otherwise hard link files to skip copying contents
+    hardlink = not version
 
-    package_json = json.load(open('ts/nni_manager/package.json'))
+    # copytree(..., dirs_exist_ok=True) is not supported by Python 3.6
+    with os.scandir('ts/nni_manager/dist') as it:
+        for entry in it:
+            if entry.is_dir():
+                _fast_copytree(entry.path, os.path.join('nni_node', entry.name), hardlink=hardlink)
+            elif entry.name != 'nni_manager.tsbuildinfo':
+                shutil.copyfile(entry.path, os.path.join('nni_node', entry.name))
+
+    package_json = json.loads(Path('ts/nni_manager/package.json').read_text())
     if version:
         while len(version.split('.')) < 3:  # node.js semver requires at least three parts
             version = version + '.0'
         package_json['version'] = version
-    json.dump(package_json, open('nni_node/package.json', 'w'), indent=2)
-
-    # reinstall without development dependencies
-    _yarn('ts/nni_manager', '--prod', '--cwd', str(Path('nni_node').resolve()))
+    Path('nni_node/package.json').write_text(json.dumps(package_json, indent=2))
+
+    # reuse dependencies of the dev build and prune development dependencies,
+    # so yarn does not need to resolve the whole tree again
+    # keep symlinks (e.g. `.bin`) as they are, some of them may be dangling
+    _fast_copytree('ts/nni_manager/node_modules', 'nni_node/node_modules', hardlink=hardlink, symlinks=True)
+    # yarn rewrites this file in place, so replace the hard link with a real copy;
+    # it must be kept because it lists files built by install scripts (e.g. sqlite3 binding),
+    # without it yarn treats them as extraneous and deletes them
+    if Path('nni_node/node_modules/.yarn-integrity').exists():
+        os.remove('nni_node/node_modules/.yarn-integrity')
+        shutil.copyfile('ts/nni_manager/node_modules/.yarn-integrity', 'nni_node/node_modules/.yarn-integrity')
+    shutil.copyfile('ts/nni_manager/yarn.lock', 'nni_node/yarn.lock')
+    _yarn('nni_node', '--production', '--offline', '--ignore-scripts')
+    os.remove('nni_node/yarn.lock')
+
+    _fast_copytree('ts/webui/build', 'nni_node/static', hardlink=hardlink)
+
+    if _get_jupyter_lab_major_version() == '2':
+        _fast_copytree('ts/jupyter_extension/build', 'nni_node/jupyter-extension/build', hardlink=hardlink)
+        _fast_copytree(os.path.join(sys.exec_prefix, 'share/jupyter/lab/extensions'), 'nni_node/jupyter-extension/extensions', hardlink=hardlink)
+    elif version or Path('ts/jupyter_extension/dist').exists():
+        _fast_copytree('ts/jupyter_extension/dist', 'nni_node/jupyter-extension', hardlink=hardlink)
 
-    shutil.copytree('ts/webui/build', 'nni_node/static')
 
-    if jupyter_lab_major_version == '2':
-        shutil.copytree('ts/jupyter_extension/build', 'nni_node/jupyter-extension/build')
-        shutil.copytree(os.path.join(sys.exec_prefix, 'share/jupyter/lab/extensions'), 'nni_node/jupyter-extension/extensions')
-    elif version or Path('ts/jupyter_extension/dist').exists():
-        shutil.copytree('ts/jupyter_extension/dist', 'nni_node/jupyter-extension')
+@lru_cache(maxsize=None)
+def _get_yarn_env():
+    # only needed with bundled toolchain, so do not copy environment when importing this module
+    env = dict(os.environ)
+    # `Path('nni_node').resolve()` does not work on Windows if the directory not exists
+    env['PATH'] = str(Path().resolve() / 'nni_node') + path_env_seperator + os.environ['PATH']
+    env['YARN_CACHE_FOLDER'] = os.environ.get('YARN_CACHE_FOLDER', str(Path.home() / '.cache/nni/yarn'))
+    return env
 
+def _get_yarn_path():
+    return Path().resolve() / 'toolchain/yarn/bin' / yarn_executable
 
-_yarn_env = dict(os.environ)
-# `Path('nni_node').resolve()` does not work on Windows if the directory not exists
-_yarn_env['PATH'] = str(Path().resolve() / 'nni_node') + path_env_seperator + os.environ['PATH']
-_yarn_path = Path().resolve() / 'toolchain/yarn/bin' / yarn_executable
+def _get_npx_path():
+    return Path().resolve() / 'toolchain/node' / npx_executable_in_tarball
 
 def _yarn(path, *args):
+    if not args or args[0].startswith('-'):  # no command means `yarn install`
+        args = (*args, '--non-interactive')
+        if '--offline' not in args:  # network options have no effect in offline mode
+            args = (*args, '--prefer-offline', '--network-timeout', '600000')
+            # a `.yarnrc` with network concurrency 1 slows down install a lot, so always set it explicitly
+            concurrency = os.environ.get('NNI_YARN_NETWORK_CONCURRENCY', '8')
+            args = (*args, '--network-concurrency', concurrency)
+        # package.json of jupyter extension is patched for JupyterLab 2, so its lockfile cannot be frozen
+        if not Path(path, '.package_default.json').exists():
+            args = (*args, '--frozen-lockfile')
+
     if os.environ.get('GLOBAL_TOOLCHAIN'):
         subprocess.run(['yarn', *args], cwd=path, check=True)
     else:
-        subprocess.run([str(_yarn_path), *args], cwd=path, check=True, env=_yarn_env)
+        subprocess.run([str(_get_yarn_path()), *args], cwd=path, check=True, env=_get_yarn_env())
+
+def _needs_build(path, output_dir):
+    """
+    Check whether the project in `path` has changed since its last successful build,
+    or its output directory is missing.
+    """
+    stamp = Path(path, '.build_stamp')
+    if not Path(path, output_dir).is_dir() or not stamp.is_file():
+        return True
+    return stamp.read_text() != _hash_project(path)
+
+def _hash_project(path):
+    # the output of JupyterLab 2 extension is linked into current environment, so it is part of the hash too
+    hash_ = hashlib.blake2b(sys.exec_prefix.encode())
+    files = [Path(path, name) for name in ['package.json', 'yarn.lock', 'tsconfig.json']]
+    files += sorted(Path(path, 'src').rglob('*'))
+    for file in files:
+        if file.is_file():
+            hash_.update(file.relative_to(path).as_posix().encode())
+            hash_.update(file.read_bytes())
+    return hash_.hexdigest()
+
+def _dedupe_lock(path):
+    # stdin is not a TTY so npx installs yarn-deduplicate without prompting
+    args = ['yarn-deduplicate', '--strategy', 'highest', 'yarn.lock']
+    if os.environ.get('GLOBAL_TOOLCHAIN'):
+        subprocess.run(['npx', *args], cwd=path, check=True, stdin=subprocess.DEVNULL)
+    else:
+        subprocess.run([str(_get_npx_path()), *args], cwd=path, check=True, env=_get_yarn_env(), stdin=subprocess.DEVNULL)
+
+def _yarn_parallel(jobs, optional=()):
+    """
+    Run `_yarn(path, *args)` for each `(path, *args)` in `jobs` concurrently.
+    Failed jobs whose path is in `optional` are reported as warnings and their paths are returned;
+    other failures are raised.
+    """
+    failed = set()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {executor.submit(_yarn, path, *args): path for path, *args in jobs}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                future.result()
+            except Exception:
+                if path not in optional:
+                    raise
+                _print_skipped(path)
+                failed.add(path)
+    return failed
+
+def _print_skipped(path):
+    _print(f'Failed to build {path}, skip for develop mode', color='yellow')
+    _print(traceback.format_exc(), color='yellow')
+
+
+def _fast_copytree(src, dst, *, hardlink=True, symlinks=False):
+    """
+    Recursively copy directory `src` to `dst`, which must not exist.
+    If `hardlink` is true, files are hard linked instead of copied when possible.
+    If `symlinks` is true, symbolic links are copied as links (possibly dangling), like `shutil.copytree`.
+    """
+    os.makedirs(dst)
+    with os.scandir(src) as it:
+        for entry in it:
+            dst_path = os.path.join(dst, entry.name)
+            if symlinks and entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dst_path, entry.is_dir())
+                continue
+            if entry.is_dir():
+                _fast_copytree(entry.path, dst_path, hardlink=hardlink, symlinks=symlinks)
+                continue
+            if hardlink:
+                try:
+                    os.link(entry.path, dst_path)
+                    continue
+                except OSError:  # cross device, or file system does not support hard links
+                    pass
+            shutil.copy2(entry.path, dst_path)
 
 
 def _symlink(target_file, link_location):
@@ -280,6 +496,7 @@ generated_files = [
     'ts/nni_manager/node_modules',
     'ts/webui/build',
     'ts/webui/node_modules',
+    'ts/jupyter_extension/.build_stamp',
 
     # unit test
     'ts/nni_manager/.nyc_output',